@@ -9,6 +9,7 @@ from benchmark_moe import benchmark_moe_3d_internal
 from benchmark_gpt import benchmark_gpt_bert_3d_internal
 from alpa import (init, global_config)
 from alpa.util import disable_tqdm_globally
+import os
 import multiprocessing as mp
 
 auto_stage_option = {
@@ -18,6 +19,18 @@ auto_stage_option = {
     "use_hlo_cost_model": False
 }
 
+# Predictor directories read by predtop.profile
+model_dir_vars = ("SAVE_MODEL_DIR", "SAVED_MODELS_DIR")
+
+def get_model_dirs():
+    return {var: os.environ[var] for var in model_dir_vars if var in os.environ}
+
+def set_model_dirs(model, base_dirs):
+    """Point the predictor directories at the subdirectory of model, so the
+    predictors of different models don't overwrite each other."""
+    for var, base in base_dirs.items():
+        os.environ[var] = os.path.join(base, model)
+
 def benchmark_one_case_internal(model,
                                 case,
                                 niter,
@@ -26,7 +39,8 @@ def benchmark_one_case_internal(model,
                                 profile_driver_time=False,
                                 profile_stage_execution_time=False,
                                 local=False,
-                                disable_tqdm=False):
+                                disable_tqdm=False,
+                                profile_dir=None):
     if disable_tqdm:
         disable_tqdm_globally()
 
@@ -47,14 +61,16 @@ def benchmark_one_case_internal(model,
             niter,
             num_hosts,
             num_devices_per_host,
-            profile_driver_time=profile_driver_time)
+            profile_driver_time=profile_driver_time,
+            profile_dir=profile_dir)
     elif model == "moe":
         result = benchmark_moe_3d_internal(
             case,
             niter,
             num_hosts,
             num_devices_per_host,
-            profile_driver_time=profile_driver_time)
+            profile_driver_time=profile_driver_time,
+            profile_dir=profile_dir)
     else:
         raise ValueError(f"Invalid model: {model}")
 
@@ -19,8 +19,8 @@ from alpa import (parallelize, get_global_cluster,
 from alpa.model.bert_model import BertConfig, FlaxBertForMaskedLMModule
 from alpa.model.model_util import TrainState
 from alpa.model.gpt_model import FlaxGPTForLMModule
-from alpa.pipeline_parallel.stage_construction import get_last_dp_result
 from alpa.util import print_used_time
+from predtop.stage import get_last_dp_result
 
 from util import compute_gpt_parameter_count, compute_gpt_tflops
 
@@ -227,7 +227,8 @@ def benchmark_gpt_bert_3d_internal(model_type,
                                    num_hosts,
                                    num_devices_per_host,
                                    aval_train_state=True,
-                                   profile_driver_time=False):
+                                   profile_driver_time=False,
+                                   profile_dir=None):
     # Connect to the cluster
     virtual_mesh = get_global_cluster().get_virtual_physical_mesh(
         host_ids=list(range(num_hosts)),
@@ -257,7 +258,8 @@ def benchmark_gpt_bert_3d_internal(model_type,
          niter,
          train_step,
          state, (batch, rngkey),
-         profile_driver_time=profile_driver_time)
+         profile_driver_time=profile_driver_time,
+         profile_dir=profile_dir)
 
     tflops, parameter_count = compute_gpt_bert_statistics(
         benchmark_case, latencies, virtual_mesh.num_devices)
@@ -12,8 +12,8 @@ from collections import namedtuple
 
 from alpa import get_global_cluster, set_global_virtual_physical_mesh
 from alpa.model.moe import FlaxMoEForLMModule, MoEConfig, TrainState
-from alpa.pipeline_parallel.stage_construction import get_last_dp_result
 from alpa.util import print_used_time
+from predtop.stage import get_last_dp_result
 import optax
 
 from benchmark_gpt import get_train_step
@@ -142,7 +142,8 @@ def benchmark_moe_3d_internal(benchmark_case,
                               niter,
                               num_hosts,
                               num_devices_per_host,
-                              profile_driver_time=False):
+                              profile_driver_time=False,
+                              profile_dir=None):
     predict_mode = benchmark_case.parallel_mode=='predict'
     # Connect to the cluster
     virtual_mesh = get_global_cluster().get_virtual_physical_mesh(
@@ -169,7 +170,8 @@ def benchmark_moe_3d_internal(benchmark_case,
          niter,
          train_step,
          state, (batch, rngkey),
-         profile_driver_time=profile_driver_time, predict=predict_mode
+         profile_driver_time=profile_driver_time, predict=predict_mode,
+         profile_dir=profile_dir
     )
      
     if predict_mode:
@@ -7,6 +7,7 @@ https://github.com/alpa-projects/alpa/blob/main/benchmark/alpa
 """
 
 from collections import namedtuple
+import logging
 import time
 import jax
 import numpy as np
@@ -16,9 +17,12 @@ from predtop.parallel import PipeshardParallel
 from predtop.stage import PredStageOption
 from alpa import (AutoShardingOption, AutoStageOption, AutoLayerOption, ManualStageOption,
                   global_config)
+from alpa import PipeshardParallel as AlpaPipeshardParallel
 from alpa.timer import timers
 from alpa.util import (print_used_time, to_str_round, list_gpu_info)
 
+logger = logging.getLogger(__name__)
+
 
 BenchmarkCase = namedtuple("BenchmarkCase", [
     "batch_size", "model_config", "num_micro_batches", "parallel_mode",
@@ -109,6 +113,32 @@ def get_pipeshard_parallel_method(benchmark_case: BenchmarkCase,
             ))
         
         
+    elif parallel_mode == "load_solution":
+        # A known stage plan does not need the latency predictor, so compile
+        # it directly with alpa's manual stage construction.
+        assert isinstance(parallel_args, LoadSolutionParallelArgs)
+        (prefer_reduce_scatter, use_remat, num_auto_layers,
+         forward_stage_layer_ids, submesh_physical_shapes,
+         submesh_logical_shapes,
+         submesh_autosharding_option_dicts) = parallel_args
+        add_manual_layer_marker = None
+        num_manual_pipeline_stages = None
+        add_manual_remat = None
+        remat_mode = "coarse_grained_remat" if use_remat else "none"
+        method = AlpaPipeshardParallel(
+            num_micro_batches=num_micro_batches,
+            default_auto_sharding_option=AutoShardingOption(
+                prefer_reduce_scatter=prefer_reduce_scatter,
+                allow_mixed_mesh_shape=allow_mixed_mesh_shape,
+            ),
+            pipeline_schedule=pipeline_schedule,
+            layer_option=AutoLayerOption(layer_num=num_auto_layers,
+                                            remat_mode=remat_mode),
+            stage_option=ManualStageOption(forward_stage_layer_ids,
+                                           submesh_physical_shapes,
+                                           submesh_logical_shapes,
+                                           submesh_autosharding_option_dicts))
+
     elif parallel_mode == "predicts":
         assert isinstance(parallel_args, LoadSolutionParallelArgs)
         (prefer_reduce_scatter, use_remat, num_auto_layers,
@@ -144,7 +174,8 @@ def benchmark_training_executable(niter,
                                   executable,
                                   state,
                                   other_train_step_inputs,
-                                  profile_driver_time=False):
+                                  profile_driver_time=False,
+                                  profile_dir=None):
     print_used_time(None)
 
     # Benchmark step time
@@ -169,16 +200,24 @@ def benchmark_training_executable(niter,
         print(f"latency with driver overhead: {e2e_latency:.3f}")
     else:
         # Benchmark latency without driver overhead
+        # No output inside the timed loop, it would perturb the latencies
         for i in range(niter):
-            print(f"Iteration {i} ...")
+            # Only trace the last iteration, which runs in steady state
+            trace = profile_dir is not None and i == niter - 1
+            if trace:
+                jax.profiler.start_trace(profile_dir)
             state = train_step(state, *other_train_step_inputs)
             if isinstance(state, tuple):
                 # In case the train_step returns extra info (e.g. loss),
                 # Get the actual state out.
                 state = state[0]
             executable.sync()
+            if trace:
+                jax.profiler.stop_trace()
 
-        latencies = executable.get_execution_time_costs()[warmup:]
+        iteration_costs = executable.get_execution_time_costs()
+        latencies = iteration_costs[warmup:]
+        logger.debug("iteration latencies: %s", iteration_costs)
 
     print_used_time("Benchmark")
 
@@ -215,7 +254,7 @@ def compile_and_benchmark_pipeshard_training_executable(
         train_step,
         state,
         other_train_step_inputs,
-        profile_driver_time=False, predict=False):
+        profile_driver_time=False, predict=False, profile_dir=None):
     res, compilation_times = compile_pipeshard_executable(
         train_step, state, other_train_step_inputs, predict)
     
@@ -228,7 +267,8 @@ def compile_and_benchmark_pipeshard_training_executable(
         res,
         state,
         other_train_step_inputs,
-        profile_driver_time=profile_driver_time)
+        profile_driver_time=profile_driver_time,
+        profile_dir=profile_dir)
     max_mem_allocated = res.mesh_group.get_max_memory_allocated()
 
     return latencies, max_mem_allocated, compilation_times, res
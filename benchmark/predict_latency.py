@@ -4,7 +4,8 @@ import numpy as np
 from alpa.util import (to_str_round, GB)
 
 from benchmark_parallel_utils import (ParallelArgs, PredictLatParallelArgs, LoadSolutionParallelArgs, BenchmarkCase)
-from benchmark import benchmark_one_case, auto_stage_option
+from benchmark import (benchmark_one_case, auto_stage_option, get_model_dirs,
+                       set_model_dirs)
 from benchmark_moe import moe_specs
 from benchmark_gpt import gpt_specs
 
@@ -86,4 +87,5 @@ if __name__ == '__main__':
                         required=True)
     args = parser.parse_args()
     
+    set_model_dirs(args.model, get_model_dirs())
     predict(args.model)
\ No newline at end of file
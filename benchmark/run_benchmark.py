@@ -1,76 +1,298 @@
-import time
+import os
 import argparse
+import hashlib
+import json
+import logging
+import pickle
 import numpy as np
-from alpa.util import (to_str_round, GB)
 
-from benchmark_parallel_utils import (ParallelArgs, BenchmarkCase)
-from benchmark import benchmark_one_case, auto_stage_option
+# XLA reads these when the backend is created, so set them before alpa/jax
+# are imported. They only reach this process and the case processes it
+# spawns. The Ray mesh workers inherit the environment of `ray start`, so
+# export them there as well to apply them to the GPU workers.
+_persistent_temp_buffers = "--xla_gpu_enable_persistent_temp_buffers=true"
+# The case processes import this module again, don't add the flag twice
+if _persistent_temp_buffers not in os.environ.get("XLA_FLAGS", ""):
+    os.environ["XLA_FLAGS"] = (os.environ.get("XLA_FLAGS", "") + " " +
+                               _persistent_temp_buffers)
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+# Use the stream-ordered cudaMallocAsync pool so activations are not
+# reallocated with cudaMalloc/cudaFree between iterations
+os.environ.setdefault("XLA_PYTHON_CLIENT_ALLOCATOR", "cuda_async")
+os.environ.setdefault("XLA_PYTHON_CLIENT_MEM_FRACTION", "0.90")
+
+from jax.experimental.compilation_cache import compilation_cache as cc
+from alpa.util import GB
+
+from benchmark_parallel_utils import (ParallelArgs, LoadSolutionParallelArgs, BenchmarkCase,
+                                      get_num_hosts_and_num_devices)
+from benchmark import (benchmark_one_case, auto_stage_option, get_model_dirs,
+                       set_model_dirs)
 from benchmark_moe import moe_specs
 from benchmark_gpt import gpt_specs
+from util import write_csv_row
+
+log = logging.getLogger("predtop.bench")
 
 moe_model = 'moe'
 gpt_model = 'gpt'
 benchmark_models = [moe_model, gpt_model]
 
-def benchmark(model_type):
-    num_hosts = 2
-    num_devices_per_host = 2
-    
-    num_micro_batches = 64
-    num_auto_layers = 32
-    prefer_reduce_scatter = True
-    use_remat = True
-    num_iteration = 3
-    
-    num_gpus = num_hosts * num_devices_per_host
-    max_global_batch_size = 1024
-    
+# Results of every benchmarked model are appended to this file
+result_file_name = "benchmark_results.csv"
+
+# Candidate numbers of micro batches; the one with the lowest latency is kept
+micro_batch_grid = [8, 16, 32, 64, 128]
+
+# Stage plans found by the auto-stage search are cached here across runs
+stage_plan_cache_dir = os.path.expanduser("~/.cache/predtop")
+# Compiled XLA executables are persisted here so later runs skip compilation
+xla_cache_dir = os.path.join(stage_plan_cache_dir, "jax_xla")
+
+# This only covers compilations in this process and in the case processes,
+# which import this module again. The Ray mesh workers compile the stage
+# executables themselves and don't use this cache.
+cc.initialize_cache(xla_cache_dir)
+
+num_auto_layers = 32
+prefer_reduce_scatter = True
+use_remat = True
+max_global_batch_size = 1024
+
+# benchmark_training_executable runs the first iteration as warmup and
+# drops it from the latencies, so request one more than is timed
+num_warmup_iteration = 1
+num_iteration_timed = 3
+num_iteration = num_iteration_timed + num_warmup_iteration
+# A single timed iteration is enough to rank the sweep points
+num_sweep_iteration = 1 + num_warmup_iteration
+
+# None of these change across the micro batch sweep, so build them once
+parallel_args = ParallelArgs(prefer_reduce_scatter, use_remat,
+                             num_auto_layers, auto_stage_option)
+
+def get_model_config(model_type):
     if model_type == moe_model:
-        model_config = moe_specs['1.3B']
+        return moe_specs['1.3B']
     elif model_type == gpt_model:
-        model_config = gpt_specs['1.3B']
+        return gpt_specs['1.3B']
     else:
         raise Exception("invalid model type")
-    
-    parallel_args = ParallelArgs(prefer_reduce_scatter, use_remat,
-                               num_auto_layers, auto_stage_option)
 
-    benchmark_case = BenchmarkCase(
+def get_predictor_id():
+    """Identity of the pretrained predictors in SAVED_MODELS_DIR, which the
+    stage search uses to pick the plan."""
+    models_dir = os.environ.get("SAVED_MODELS_DIR")
+    if models_dir is None:
+        return None
+    with os.scandir(models_dir) as it:
+        files = sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns)
+                       for e in it if e.is_file())
+    return os.path.abspath(models_dir), files
+
+def get_stage_plan_path(model_type, num_hosts, num_devices_per_host,
+                        num_micro_batches):
+    key = hashlib.sha1(repr((
+        model_type, get_model_config(model_type), num_hosts,
+        num_devices_per_host, num_micro_batches, prefer_reduce_scatter,
+        use_remat, num_auto_layers, sorted(auto_stage_option.items()),
+        get_predictor_id())).encode()).hexdigest()
+    return os.path.join(stage_plan_cache_dir, f"stage_plan_{key}.pkl")
+
+def check_config(num_gpus):
+    """Reject configurations that would only fail after the stage search."""
+    for num_micro_batches in micro_batch_grid:
+        if max_global_batch_size % num_micro_batches != 0:
+            raise ValueError(f"{max_global_batch_size=} is not divisible by "
+                             f"{num_micro_batches=}")
+    # The layers are partitioned evenly over the GPUs
+    if num_auto_layers % num_gpus != 0 and num_gpus % num_auto_layers != 0:
+        divisors = [n for n in range(1, num_auto_layers + 1)
+                    if num_auto_layers % n == 0]
+        raise ValueError(
+            f"{num_gpus} GPUs can't evenly partition {num_auto_layers} layers, "
+            f"use a GPU count in {divisors} or a multiple of {num_auto_layers}")
+
+def build_case(model_type, num_micro_batches, num_hosts, num_devices_per_host,
+               load_plan=True):
+    """Create a benchmark case, reusing a cached stage plan if load_plan is
+    set and one is available."""
+    model_config = get_model_config(model_type)
+    plan_path = get_stage_plan_path(model_type, num_hosts,
+                                    num_devices_per_host, num_micro_batches)
+    if not load_plan or not os.path.exists(plan_path):
+        return BenchmarkCase(
+            max_global_batch_size,
+            model_config,
+            num_micro_batches,
+            'search',
+            parallel_args
+        )
+
+    with open(plan_path, "rb") as f:
+        (forward_stage_layer_ids, submesh_shapes, logical_mesh_shapes,
+         autosharding_option_dicts) = pickle.load(f)
+    log.info("Loaded stage plan from %s", plan_path)
+    solution_args = LoadSolutionParallelArgs(
+        prefer_reduce_scatter, use_remat, num_auto_layers,
+        forward_stage_layer_ids, submesh_shapes, logical_mesh_shapes,
+        autosharding_option_dicts)
+    return BenchmarkCase(
         max_global_batch_size,
         model_config,
         num_micro_batches,
-        'search',
-        parallel_args
+        'load_solution',
+        solution_args
     )
 
-    # Run one case
-    print("Working on case: {}".format(str(benchmark_case)))
+def save_stage_plan(plan_path, metadata):
+    """Store the stage plan found by the search in the metadata."""
+    if metadata is None or metadata["forward_stage_layer_ids"] is None:
+        return
+    os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+    with open(plan_path, "wb") as f:
+        pickle.dump((metadata["forward_stage_layer_ids"],
+                     metadata["submesh_shapes"],
+                     metadata["logical_mesh_shapes"],
+                     metadata["autosharding_option_dicts"]), f)
+
+def run_case(case, model_type, niter, num_hosts, num_devices_per_host,
+             profile_dir=None, save_plan=True):
+    """Run one benchmark case and, if save_plan is set, cache the stage plan
+    it searched for.
+
+    Every case runs in its own process, so the executables, meshes and GPU
+    memory of a case don't outlive it and skew the cases after it.
+    Returns None if the case failed.
+    """
+    log.info("Working on case: %s", case)
     result = benchmark_one_case(
         model_type,
-        benchmark_case,
-        num_iteration,
+        case,
+        niter,
         num_hosts,
-        num_devices_per_host)
+        num_devices_per_host,
+        use_separate_process=True,
+        profile_dir=profile_dir)
+    if result[0] == -1:
+        log.warning("Case failed: %s", case)
+        return None
+
+    if save_plan and case.parallel_mode == 'search':
+        plan_path = get_stage_plan_path(model_type, num_hosts,
+                                        num_devices_per_host,
+                                        case.num_micro_batches)
+        save_stage_plan(plan_path, result[4])
+    return result
+
+def benchmark(model_type, num_hosts, num_devices_per_host, profile_dir=None,
+              refresh_plan=False):
+    num_gpus = num_hosts * num_devices_per_host
+    # Training predictors (SAVE_MODEL_DIR) needs the full search, so cached
+    # plans are neither used nor written then. refresh_plan ignores the plans
+    # cached by earlier runs and replaces them.
+    use_plan_cache = os.environ.get("SAVE_MODEL_DIR") is None
 
+    # Sweep the number of micro batches with short runs
+    sweep_results = []
+    for num_micro_batches in micro_batch_grid:
+        case = build_case(model_type, num_micro_batches, num_hosts,
+                          num_devices_per_host,
+                          load_plan=use_plan_cache and not refresh_plan)
+        result = run_case(case, model_type, num_sweep_iteration, num_hosts,
+                          num_devices_per_host, save_plan=use_plan_cache)
+        if result is None:
+            continue
+        (_, _, latencies, tflops, _) = result
+
+        latency_mean = np.asarray(latencies, dtype=np.float64).mean()
+        sweep_results.append((num_micro_batches, latency_mean, tflops))
+        log.info("num_micro_batches: %d, latency: %.3f, tflops: %.2f",
+                 num_micro_batches, latency_mean, tflops)
+
+    if not sweep_results:
+        raise RuntimeError(f"every micro batch sweep case of {model_type} failed")
+    best_idx = int(np.argmin([lat for _, lat, _ in sweep_results]))
+    num_micro_batches = sweep_results[best_idx][0]
+
+    # Rerun the best configuration with the full number of iterations, with
+    # the plan its sweep case just found
+    case = build_case(model_type, num_micro_batches, num_hosts,
+                      num_devices_per_host, load_plan=use_plan_cache)
+    if profile_dir is not None:
+        profile_dir = os.path.join(profile_dir, model_type)
+    result = run_case(case, model_type, num_iteration, num_hosts,
+                      num_devices_per_host, profile_dir=profile_dir,
+                      save_plan=use_plan_cache)
+    if result is None:
+        raise RuntimeError(f"the best case of {model_type} failed on rerun")
     (parameter_count, peak_mem, latencies, tflops, metadata) = result
 
-    values = [
-        model_type, model_config, num_micro_batches, num_gpus,
-        parallel_args, f"{np.mean(latencies):.3f}",
-        f"{np.std(latencies):.3f}", f"{parameter_count/1e9:.3f}B",
-        f"{tflops:.2f}", f"{peak_mem/GB:.3f}",
-        to_str_round(metadata, 2)
-    ]
-    
-    print(values)
-
-    time.sleep(0.1)
-    
+    latencies = np.asarray(latencies, dtype=np.float64)
+    assert len(latencies) == num_iteration_timed, (
+        f"expected {num_iteration_timed} timed iterations, got {len(latencies)}")
+    row = {
+        "model": model_type,
+        "num_gpus": num_gpus,
+        "micro_batches": num_micro_batches,
+        "latency_mean": float(latencies.mean()),
+        "latency_std": float(latencies.std()),
+        "params_B": parameter_count / 1e9,
+        "tflops": tflops,
+        "peak_mem_GB": peak_mem / GB,
+        "warmup_dropped": num_warmup_iteration,
+    }
+    # The result row stays on stdout so it can be parsed from the output
+    print(json.dumps(row), flush=True)
+    write_csv_row(row, result_file_name)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--model",
                         choices=benchmark_models,
                         type=str,
-                        required=True)
+                        nargs='+',
+                        default=benchmark_models)
+    _, local_num_devices = get_num_hosts_and_num_devices()
+    parser.add_argument("--num-hosts",
+                        type=int,
+                        default=int(os.environ.get("PREDTOP_NUM_HOSTS", 1)))
+    parser.add_argument("--devices-per-host",
+                        type=int,
+                        default=local_num_devices)
+    parser.add_argument("--profile",
+                        type=str,
+                        default=None,
+                        help="Write a JAX profiler trace of the last timed "
+                        "iteration of the best case to this directory")
+    parser.add_argument("--refresh-plan",
+                        action="store_true",
+                        help="Search the stage plans again instead of loading "
+                        "the ones cached by earlier runs")
+    parser.add_argument("--verbose",
+                        action="store_true",
+                        help="Log per-iteration progress of the benchmark")
     args = parser.parse_args()
-    benchmark(args.model)
\ No newline at end of file
+    if args.num_hosts < 1 or args.devices_per_host < 1:
+        parser.error("--num-hosts and --devices-per-host must be positive")
+    # Hosts are assumed to be homogeneous, so each one has as many devices as
+    # this one
+    if args.devices_per_host > local_num_devices:
+        parser.error(
+            f"--num-hosts {args.num_hosts} x --devices-per-host "
+            f"{args.devices_per_host} needs {args.devices_per_host} devices "
+            f"per host, but only {local_num_devices} are available here")
+    try:
+        check_config(args.num_hosts * args.devices_per_host)
+    except ValueError as e:
+        parser.error(str(e))
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(message)s")
+    # Every case runs in its own process (see run_case), each model keeps its
+    # predictors in its own subdirectory
+    base_model_dirs = get_model_dirs()
+    for model_type in args.model:
+        set_model_dirs(model_type, base_model_dirs)
+        benchmark(model_type, args.num_hosts, args.devices_per_host,
+                  profile_dir=args.profile, refresh_plan=args.refresh_plan)
+
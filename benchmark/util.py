@@ -1,3 +1,4 @@
+import csv
 import os
 import time
 
@@ -22,6 +23,16 @@ def write_tsv(heads, values, filename, print_line=True):
         print(line)
 
 
+def write_csv_row(row, filename):
+    """Append a dict as one row to a csv file, writing the header if new."""
+    new_file = not os.path.exists(filename)
+    with open(filename, "a", newline="") as fout:
+        writer = csv.DictWriter(fout, fieldnames=list(row))
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
 def benchmark_func(run_func, sync_func=None, warmup=1, repeat=3, number=5):
     """Benchmark the execution time of a function."""
     costs = []
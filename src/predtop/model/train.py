@@ -164,26 +164,36 @@ def run(graphs, targets, device=None):
 
     return model_f
 
-def pred(model, graphs, scale_target=100):
-  device = get_device()
-  outputs = torch.tensor([]).to(device)
+def pred_batches(graphs, device=None, batch_size=256):
+  """Featurize and collate graphs once so several models can reuse them."""
+  if device==None:
+    device=get_device()
 
   infr_fn = gcn_process_inference_graphs if MOD == 'gcn' else process_inference_graphs
 
-  loader = infr_fn(graphs, device=device, batch_size=256)
+  return list(infr_fn(graphs, device=device, batch_size=batch_size))
+
+def pred(model, graphs, scale_target=100, batches=None):
+  device = get_device()
+  outputs = []
+
+  if batches is None:
+    batches = pred_batches(graphs, device=device)
 
-  model.eval()
+  model.to(device).eval()
 
   if MOD == 'gcn':
-    with torch.no_grad():
-        for graph in loader: 
+    with torch.inference_mode():
+        for graph in batches: 
             out = model(graph.x, graph.edge_index, graph.batch)  # Perform a single forward pass.
-            outputs = torch.cat((outputs, out), 0)
+            outputs.append(out)
   elif MOD == 'transform':
-    with torch.no_grad():
-        for graph in loader: 
+    with torch.inference_mode():
+        for graph in batches: 
             out = model(graph)  # Perform a single forward pass.
-            outputs = torch.cat((outputs, out), 0)
+            outputs.append(out)
 
+  # Single device to host copy for all batches
+  outputs = torch.cat(outputs, 0) if outputs else torch.tensor([])
   res = (torch.squeeze(outputs).detach().cpu().numpy())/scale_target
   return res
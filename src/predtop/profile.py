@@ -6,14 +6,21 @@ https://github.com/alpa-projects/alpa/blob/main/alpa/pipeline_parallel/stage_pro
 
 """
 import os
+import sys
+import copy
+import hashlib
+import inspect
+import uuid
 from time import time
 from datetime import datetime
 import logging
 import pickle
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Sequence, Tuple
 import numpy as np
 import tqdm
-import random
 import itertools
 import warnings
 from pathlib import Path
@@ -36,7 +43,7 @@ from alpa.util import (jaxpr_to_hlo, OrderedSet)
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", message="networkx backend defined more than once: nx-loopback")
     import networkx as nx
-from predtop.model.train import run, pred, create_model
+from predtop.model.train import run, pred, pred_batches, create_model
 from alpa.pipeline_parallel.stage_profiling import (
     ModuleProfileConfig,
     _get_layer_flops_prefix_sum,
@@ -57,70 +64,108 @@ last_compute_cost_file_name = None
 INFINITY_N_STAGES = 2**20
 GB = 1024**3
 
-def get_training_stages_to_profile(layers, prob=1, reduce=0, exclude=[], all_st_ends=None):
-    print("- Generate all stage infos (Jaxpr -> HLO)")
-    assert len(layers) % 2 == 0
-    num_layers = len(layers) // 2
-    expected_stages_num = int(prob * (num_layers * (num_layers + 1) / 2))
+_rng = np.random.default_rng()
+_uuid4 = uuid.uuid4
 
-    st_end = []
+_NPY_MAGIC = b"\x93NUMPY"
+# State dicts of all trained predictors, keyed by "{mesh_id}_{as_id}"
+_MESH_MODELS_ARCHIVE = 'mesh_models.pt'
+
+# torch.load(mmap=...) needs torch>=2.1, older versions read the whole file
+_TORCH_LOAD_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+# Single-input primitives that only alias their input in the graph
+_ALIAS_PRIMITIVES = frozenset(['reshape', 'convert_element_type', 'broadcast_in_dim'])
+# Primitives whose sub-jaxpr is inlined into the graph
+_CALL_PRIMITIVES = frozenset(['custom_jvp_call', 'remat2', 'named_call'])
+
+def _enumerate_st_end(num_layers, prob=1, reduce=0, exclude=(), all_st_ends=None, rng=None):
+    """Sample the (start, end) layer pairs of the stages to profile.
+
+    rng is a seed or np.random.Generator, the module generator by default.
+    Returns an int array of shape (N, 2).
+    """
+    if all_st_ends is not None:
+        return np.asarray(all_st_ends, dtype=np.int64).reshape(-1, 2)
+    rng = _rng if rng is None else np.random.default_rng(rng)
+
+    expected_stages_num = int(prob * (num_layers * (num_layers + 1) / 2))
 
     min_wid_limit = 0 if prob==1 else 2 # stages should have minimum 2 layers
-    print('exclude', exclude)
     max_wid_limit = num_layers - reduce
 
     wid_step = max(int(num_layers/expected_stages_num), 1)
 
-    print(expected_stages_num, num_layers)
-    print(min_wid_limit, max_wid_limit, wid_step)
-
-    wid_range = list(range(min_wid_limit, max_wid_limit, wid_step))
+    # Stages may start at any layer that is not excluded
+    start_mask = np.ones(num_layers, dtype=bool)
+    exclude = frozenset(exclude)
+    excluded = np.fromiter(exclude, dtype=np.int64, count=len(exclude))
+    start_mask[excluded[(excluded >= 0) & (excluded < num_layers)]] = False
 
-    if all_st_ends != None:
-        st_end = all_st_ends
-    else:
-        for wid in wid_range:
-        # for wid in range(5):
-            dds = list(range(num_layers - wid))
-
-            count = int((num_layers - wid) * prob)
-            count = max(1, count)
-            starts = random.sample([el for el in dds if el not in exclude], count)
-            # print(dds, wid)
-            st_end += [(i, i + wid) for i in starts]
-        # print([(i, i + wid) for i in starts])
-
-        if len(st_end) > expected_stages_num:
-            st_end = random.sample(st_end, expected_stages_num)
+    st_end = []
+    for wid in range(min_wid_limit, max_wid_limit, wid_step):
+        count = max(1, int((num_layers - wid) * prob))
+        valid_starts = np.flatnonzero(start_mask[:num_layers - wid])
+        starts = rng.choice(valid_starts, size=count, replace=False)
+        st_end.append(np.stack([starts, starts + wid], axis=1))
+
+    if len(st_end) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    st_end = np.concatenate(st_end)
+
+    if len(st_end) > expected_stages_num:
+        st_end = st_end[rng.choice(len(st_end), size=expected_stages_num,
+                                    replace=False)]
     return st_end
 
-def process_training_stages_2d(st_end, layers,
-                                accumulator_mapping,
-                                acc_grad_invars,
-                                acc_grad_outvars,
-                                apply_grad_layers,
-                                apply_grad_global_info,
-                                mesh_id,
-                                autosharding_configs,
-                                mesh_num_devices,
-                                cluster_size,
-                                compile=True):
+def get_training_stages_to_profile(layers, prob=1, reduce=0, exclude=(), all_st_ends=None, rng=None):
     print("- Generate all stage infos (Jaxpr -> HLO)")
     assert len(layers) % 2 == 0
     num_layers = len(layers) // 2
+    print('exclude', exclude)
 
+    st_end = _enumerate_st_end(num_layers, prob, reduce, exclude, all_st_ends, rng)
+    return [tuple(se) for se in st_end.tolist()]
+
+def _chunk_by_size(items, sizes, limit):
+    """Greedily split items into consecutive chunks whose sizes sum to at most
+    limit. An item larger than limit gets a chunk of its own."""
+    cum = np.cumsum(sizes)
+    bounds = [0]
+    while bounds[-1] < len(items):
+        start = bounds[-1]
+        base = cum[start - 1] if start else 0
+        end = int(np.searchsorted(cum, base + limit, side='right'))
+        bounds.append(max(end, start + 1))
+    return [items[st:end] for st, end in zip(bounds, bounds[1:])]
+
+
+def _compile_stages(st_end, layers,
+                    accumulator_mapping,
+                    acc_grad_invars,
+                    acc_grad_outvars,
+                    apply_grad_layers,
+                    apply_grad_global_info,
+                    mesh_id,
+                    autosharding_configs,
+                    is_full_mesh,
+                    compile=True):
+    """Generate the stage info of every (start, end) pair for each
+    autosharding config."""
+    num_layers = len(layers) // 2
     indices = list(range(2 * num_layers))
-    computation_source_ratio = mesh_num_devices / cluster_size
-    is_full_mesh = computation_source_ratio == 1
-    stages = []
 
+    # DATAGEN: generate for full mesh
     if is_full_mesh:
         st_end = [(0, num_layers-1)]
 
-    len_stend = len(st_end)
+    configs = [(config_idx, autosharding_config)
+               for config_idx, autosharding_config in enumerate(autosharding_configs)
+               if autosharding_config is not None]
+    stages = [None] * (len(st_end) * len(configs))
+    k = 0
 
-    for elti in tqdm.tqdm(range(0, len_stend)):
-        elt = st_end[elti]
+    def stage_info(elt):
         start = elt[0]
         end = elt[1]
 
@@ -133,18 +178,40 @@ def process_training_stages_2d(st_end, layers,
             if apply_grad_layers[idx] is not None
         ]
         stage_name = f"stage_{start}_{end}"
-        stage_config, mmjpr= generate_stage_info(
+        return generate_stage_info(
             layers, [forward_layer_indices, backward_layer_indices],
             accumulator_mapping, acc_grad_invars, acc_grad_outvars,
             stage_name, selected_apply_grad_layers, apply_grad_global_info, compile=compile)
-        for config_idx, autosharding_config in enumerate(
-                autosharding_configs):
-            if autosharding_config is not None:
-                stage_indices = (start, end, mesh_id, config_idx)
-                stages.append(
-                    (stage_indices, stage_config, autosharding_config, mmjpr))
+
+    for elt in tqdm.tqdm(st_end):
+        stage_config, mmjpr = stage_info(elt)
+        for config_idx, autosharding_config in configs:
+            stage_indices = (elt[0], elt[1], mesh_id, config_idx)
+            stages[k] = (stage_indices, stage_config, autosharding_config, mmjpr)
+            k += 1
     return stages
 
+def process_training_stages_2d(st_end, layers,
+                                accumulator_mapping,
+                                acc_grad_invars,
+                                acc_grad_outvars,
+                                apply_grad_layers,
+                                apply_grad_global_info,
+                                mesh_id,
+                                autosharding_configs,
+                                mesh_num_devices,
+                                cluster_size,
+                                compile=True):
+    print("- Generate all stage infos (Jaxpr -> HLO)")
+    assert len(layers) % 2 == 0
+    is_full_mesh = mesh_num_devices / cluster_size == 1
+
+    return _compile_stages(st_end, layers, accumulator_mapping,
+                           acc_grad_invars, acc_grad_outvars,
+                           apply_grad_layers, apply_grad_global_info,
+                           mesh_id, autosharding_configs, is_full_mesh,
+                           compile=compile)
+
 def generate_training_stages_2d(layers,
                                 layer_flops_prefix_sum,
                                 accumulator_mapping,
@@ -156,76 +223,56 @@ def generate_training_stages_2d(layers,
                                 autosharding_configs,
                                 mesh_num_devices,
                                 cluster_size,
-                                stage_imbalance_tolerance=np.inf, compile=True, prob=1, reduce=0, exclude=[], all_st_ends=None):
+                                stage_imbalance_tolerance=np.inf, compile=True, prob=1, reduce=0, exclude=(), all_st_ends=None, rng=None):
     print("- Generate all stage infos (Jaxpr -> HLO)")
     assert len(layers) % 2 == 0
     num_layers = len(layers) // 2
-    expected_stages_num = int(prob * (num_layers * (num_layers + 1) / 2))
-    indices = list(range(2 * num_layers))
-    computation_source_ratio = mesh_num_devices / cluster_size
-    is_full_mesh = computation_source_ratio == 1
-    tot_flops = layer_flops_prefix_sum[2 * num_layers]
-    stages = []
+    is_full_mesh = mesh_num_devices / cluster_size == 1
 
+    # The full mesh only profiles the whole model, no need to sample stages
     st_end = []
-    end = num_layers
+    if not is_full_mesh:
+        st_end = [tuple(se) for se in _enumerate_st_end(
+            num_layers, prob, reduce, exclude, all_st_ends, rng).tolist()]
 
-    min_wid_limit = 0 if prob==1 else 2 # stages should have minimum 2 layers
-    
-    max_wid_limit = num_layers - reduce
+    return _compile_stages(st_end, layers, accumulator_mapping,
+                           acc_grad_invars, acc_grad_outvars,
+                           apply_grad_layers, apply_grad_global_info,
+                           mesh_id, autosharding_configs, is_full_mesh,
+                           compile=compile)
 
-    wid_step = max(int(num_layers/expected_stages_num), 1)
 
-    wid_range = list(range(min_wid_limit, max_wid_limit, wid_step))
+class _GraphBuilder:
+    """Flat node/edge tables with the subset of the nx.DiGraph API used by
+    _jaxpr_graph_g. Turned into a DiGraph in one pass once the graph is done.
 
-    if all_st_ends != None:
-        st_end = all_st_ends
-    else:
-        for wid in wid_range:
-        # for wid in range(5):
-            dds = list(range(num_layers - wid))
-
-            count = int((num_layers - wid) * prob)
-            count = max(1, count)
-            starts = random.sample([el for el in dds if el not in exclude], count)
-            # print(dds, wid)
-            st_end += [(i, i + wid) for i in starts]
+    Nodes and edges keep their insertion order so the resulting DiGraph is
+    identical to one built node by node.
+    """
 
-        if len(st_end) > expected_stages_num:
-            st_end = random.sample(st_end, expected_stages_num)
-
-    # DATAGEN: generate for full mesh
-    if is_full_mesh:
-        st_end = [(0, num_layers-1)]
+    def __init__(self):
+        self.nodes = {}
+        self.edges = {}
 
-    len_stend = len(st_end)
+    def add_node(self, n, **attr):
+        node = self.nodes.get(n)
+        if node is None:
+            self.nodes[n] = attr
+        else:
+            node.update(attr)
 
-    for elti in tqdm.tqdm(range(0, len_stend)):
-        elt = st_end[elti]
-        start = elt[0]
-        end = elt[1]
+    def add_edge(self, u, v):
+        if u not in self.nodes:
+            self.nodes[u] = {}
+        if v not in self.nodes:
+            self.nodes[v] = {}
+        self.edges[(u, v)] = None
 
-        forward_layer_indices = indices[start:end + 1]
-        backward_layer_indices = indices[2 * num_layers - end -
-                                            1:2 * num_layers - start]
-        selected_apply_grad_layers = [
-            apply_grad_layers[idx]
-            for idx in forward_layer_indices
-            if apply_grad_layers[idx] is not None
-        ]
-        stage_name = f"stage_{start}_{end}"
-        stage_config, mmjpr= generate_stage_info(
-            layers, [forward_layer_indices, backward_layer_indices],
-            accumulator_mapping, acc_grad_invars, acc_grad_outvars,
-            stage_name, selected_apply_grad_layers, apply_grad_global_info, compile=compile)
-        for config_idx, autosharding_config in enumerate(
-                autosharding_configs):
-            if autosharding_config is not None:
-                stage_indices = (start, end, mesh_id, config_idx)
-                stages.append(
-                    (stage_indices, stage_config, autosharding_config, mmjpr))
-                    # (stage_indices, stage_config, autosharding_config))
-    return stages
+    def to_networkx(self):
+        G = nx.DiGraph()
+        G.add_nodes_from(self.nodes.items())
+        G.add_edges_from(self.edges)
+        return G
 
 
 def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvars':[]}, jpridx=0, pref = "", jaxpr_invars=[], remat=False, update_nodes={}):
@@ -245,41 +292,57 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
     else:
         raise Exception("invalid")
 
-    def get_ivr(dict, key):
+    # str() of vars and avals is requested many times per eqn, memoize it
+    _vstr = {}
+    _avstr = {}
+
+    def sv(v):
+        r = _vstr.get(id(v))
+        if r is None:
+            r = _vstr[id(v)] = str(v)
+        return r
+
+    def short(aval):
+        r = _avstr.get(id(aval))
+        if r is None:
+            r = _avstr[id(aval)] = aval.str_short()
+        return r
+
+    def get_ivr(dict, key, compress=False):
         st = str(key)
+        visited = []
         while st in dict:
+            if compress:
+                visited.append(st)
             st = dict[st]
+        # Point the whole chain at its end so later lookups are O(1)
+        for k in visited:
+            dict[k] = st
         return st
 
-    def get_ovr(dict, key):
-        new_dict = {}
-        for v in dict:
-            k = dict[v]
-            new_dict[k] = v
-
-        return get_ivr(new_dict, key)
+    # Reverse index of md['outvars'] (value -> keys in insertion order),
+    # md is not modified below so it is built once per call
+    _ov_rev = {}
+    if jtype != 0:
+        for k, v in md['outvars'].items():
+            _ov_rev.setdefault(v, []).append(k)
 
-    def get_ovrs(dict, key):
-        ovrs = []
-        for k in dict:
-            v = dict[k]
-            if v == key:
-                ovrs.append(k)
+    def get_ovrs(key):
+        return _ov_rev.get(key, [key])
 
-        if len(ovrs) == 0:
-            return [key]
-        else:
-            return ovrs
-
-    if G is None:
-        G = nx.DiGraph()
+    # Only the outermost call converts the tables into a DiGraph
+    is_root = G is None
+    if is_root:
+        G = _GraphBuilder()
+    # Membership tests go straight to the node table
+    nodes = G.nodes
 
     if id_names is None:
         id_names = (f'id{id}' for id in itertools.count())
 
     for v in jaxpr.constvars:
         G.add_node(
-            pref + str(v),
+            pref + sv(v),
             label=core.raise_to_shaped(v.aval).str_short(),
             shape=v.aval.shape,
             dtype=str(v.aval.dtype),
@@ -287,12 +350,12 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
             remat=remat,
         )
     if jtype == 0:
-        jaxpr_invars = [str(v) for v in jaxpr.invars]
+        jaxpr_invars = [sv(v) for v in jaxpr.invars]
         # TODO: FIX this is needed for combined layer stages generation
         for v in jaxpr.invars:
             G.add_node(
-                str(v),
-                label=str(v) + v.aval.str_short(),
+                sv(v),
+                label=sv(v) + short(v.aval),
                 shape=v.aval.shape,
                 dtype=str(v.aval.dtype),
                 type='invar',
@@ -300,43 +363,50 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
             )
 
     for eqn in jaxpr.eqns:
-        if str(eqn.primitive) == 'pipeline_marker':
+        prim = eqn.primitive.name
+        if prim == 'pipeline_marker':
+            mark_type = eqn.params['mark_type']
             for i, inv in enumerate(eqn.invars):
 
                 v = eqn.outvars[i]
+                v_name = sv(v)
+                inv_name = sv(inv)
 
-                if not G.has_node(str(v)):
-                    edge_from = str(inv)
+                if v_name not in nodes:
+                    edge_from = inv_name
                     ntype = 'intermediate'
 
-                    if jtype == 0 and eqn.params['mark_type'] == 'start' and str(inv) in jaxpr_invars:
-                        edge_from = 'in ' + str(inv)
+                    is_stage_invar = (jtype == 0 and mark_type == 'start' and
+                                      inv_name in jaxpr_invars)
+                    if is_stage_invar:
+                        edge_from = 'in ' + inv_name
                         ntype = 'invar'
 
-                    if eqn.params['mark_type'] == 'end' and str(inv) in update_nodes:
-                        update_nodes[str(v)] = str(inv)
+                    if mark_type == 'end' and inv_name in update_nodes:
+                        update_nodes[v_name] = inv_name
                         continue
 
                     G.add_node(
-                        str(v),
-                        label=str(v) + v.aval.str_short(),
+                        v_name,
+                        label=v_name + short(v.aval),
                         shape=v.aval.shape,
                         dtype=str(v.aval.dtype),
                         type=ntype,
                         remat=remat,
                     )
-                    if jtype == 0 and eqn.params['mark_type'] == 'start' and str(inv) in jaxpr_invars:
+                    if is_stage_invar:
                         continue
 
-                    G.add_edge(edge_from, str(v))
+                    G.add_edge(edge_from, v_name)
             continue
 
-        if str(eqn.primitive) == 'custom_jvp_call':
+        if prim == 'custom_jvp_call':
             sub_jaxpr = eqn.params['call_jaxpr'].jaxpr
             outv, = eqn.outvars
+            edge_to = pref + sv(outv)
             G.add_node(
-                pref + str(outv),
-                label=str(sub_jaxpr.eqns[0].primitive),
+                edge_to,
+                label=sub_jaxpr.eqns[0].primitive.name,
                 shape=outv.aval.shape,
                 dtype=str(outv.aval.dtype),
                 type='op_node',
@@ -345,7 +415,7 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
 
             for v in [sub_jaxpr.eqns[0].invars[1]] + eqn.invars:
                 if jtype != 0 and v in jaxpr.invars:
-                    ivr = get_ivr(md['invars'], v)
+                    ivr = get_ivr(md['invars'], sv(v), compress=True)
 
                     if isinstance(v, core.Literal):
                         id_name = next(id_names)
@@ -358,18 +428,15 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
                             remat=remat,
                         )
                         edge_from = pref + id_name
-                    elif G.has_node(pref + ivr):
+                    elif pref + ivr in nodes:
                         edge_from = pref + ivr
                     else:
                         edge_from = ivr
 
-
-                    edge_to = pref + str(outv)
-
                     G.add_edge(edge_from, edge_to)
 
                 else:
-                    edge_from = str(v)
+                    edge_from = sv(v)
                     if isinstance(v, core.Literal):
                         id_name = next(id_names)
                         G.add_node(
@@ -383,12 +450,10 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
 
                         edge_from = pref + id_name
 
-                    edge_to = pref + str(outv)
-
                     G.add_edge(edge_from, edge_to)
             continue
 
-        if str(eqn.primitive) in ['reshape', 'convert_element_type', 'broadcast_in_dim'] and len(eqn.invars) == 1:
+        if prim in _ALIAS_PRIMITIVES and len(eqn.invars) == 1:
             v = eqn.invars[0]
 
             if isinstance(v, core.Literal):
@@ -401,42 +466,41 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
                     type='literal',
                     remat=remat,
                 )
-                update_nodes[str(eqn.outvars[0])] = id_name
+                update_nodes[sv(eqn.outvars[0])] = id_name
             else:
-                iv_r = get_ivr(md['invars'], v)
-                update_nodes[str(eqn.outvars[0])] = iv_r
+                iv_r = get_ivr(md['invars'], sv(v), compress=True)
+                update_nodes[sv(eqn.outvars[0])] = iv_r
             continue
 
-        import uuid
         npref = ""
-        if str(eqn.primitive) in ['custom_jvp_call', 'remat2', 'named_call']:
-            if str(eqn.primitive) == 'remat2':
+        if prim in _CALL_PRIMITIVES:
+            if prim == 'remat2':
                 sub_jaxpr = eqn.params['jaxpr']
 
-            elif str(eqn.primitive) == 'custom_jvp_call':
+            elif prim == 'custom_jvp_call':
                 sub_jaxpr = eqn.params['call_jaxpr'].jaxpr
-                npref = str(uuid.uuid4())[:8] + " "
-            elif str(eqn.primitive) == 'named_call':
+                npref = _uuid4().hex[:8] + " "
+            elif prim == 'named_call':
                 sub_jaxpr = eqn.params['call_jaxpr']
 
             invar_dict = {}
             outvar_dict = {}
 
             for i_i, i_val in enumerate(sub_jaxpr.invars):
-                i_v = str(i_val)
+                i_v = sv(i_val)
 
                 if i_v in md['invars']:
                     invar_dict[i_v] = md['invars'][i_v]
                 else:
-                    invar_dict[i_v] = str(eqn.invars[i_i])
+                    invar_dict[i_v] = sv(eqn.invars[i_i])
 
             for i_i, i_val in enumerate(sub_jaxpr.outvars):
-                i_v = str(i_val)
+                i_v = sv(i_val)
 
                 if i_v in md['outvars']:
                     outvar_dict[i_v] = md['outvars'][i_v]
                 else:
-                    outvar_dict[str(eqn.outvars[i_i])] = i_v
+                    outvar_dict[sv(eqn.outvars[i_i])] = i_v
 
 
             invar_dict.update(md['invars'])
@@ -451,7 +515,7 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
                 pref=npref,
                 jaxpr_invars = jaxpr_invars,
                 md={'invars': invar_dict, 'outvars': outvar_dict},
-                remat=str(eqn.primitive) == 'remat2',
+                remat=prim == 'remat2',
                 update_nodes=update_nodes,
             )
 
@@ -469,7 +533,7 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
 
             if eqn.primitive.multiple_results:
                 id_name = next(id_names)
-                node_id = str(eqn.primitive) + "_" + id_name
+                node_id = prim + "_" + id_name
                 G.add_node(
                     id_name,
                     label= node_id, #id_name,#str(eqn.primitive),
@@ -481,13 +545,13 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
 
                 for i, v in enumerate(eqn.invars):
                     if jtype != 0 and v in jaxpr.invars:
-                        iv_r = get_ivr(md['invars'], v)
+                        iv_r = get_ivr(md['invars'], sv(v), compress=True)
 
                         ivr = get_ivr(update_nodes, iv_r)
 
                         if isinstance(v, core.Literal):
                             edge_from = str(id(v.val))
-                        elif G.has_node(pref + ivr):
+                        elif pref + ivr in nodes:
                             edge_from = pref + ivr
                         else:
                             edge_from = ivr
@@ -496,27 +560,27 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
 
                         G.add_edge(edge_from, edge_to)
                     else:
-                        from_node = str(v)
                         if isinstance(v, core.Literal):
                             from_node = str(id(v.val))
                         else:
-                            from_node = get_ivr(update_nodes, from_node)
+                            from_node = get_ivr(update_nodes, sv(v))
                         G.add_edge(from_node, id_name)
                 for v in eqn.outvars:
                     G.add_node(
-                        pref + str(v),
-                        label=v.aval.str_short(),
+                        pref + sv(v),
+                        label=short(v.aval),
                         shape=v.aval.shape,
                         dtype=str(v.aval.dtype),
                         type='intermediate',
                         remat=remat
                     )
-                    G.add_edge(id_name, pref + str(v))
+                    G.add_edge(id_name, pref + sv(v))
             else:
                 outv, = eqn.outvars
+                outv_name = sv(outv)
                 G.add_node(
-                    pref + str(outv),
-                    label=str(eqn.primitive),
+                    pref + outv_name,
+                    label=prim,
                     shape=outv.aval.shape,
                     dtype=str(outv.aval.dtype),
                     type='op_node',
@@ -525,60 +589,273 @@ def _jaxpr_graph_g(jpl, G=None, id_names=None, jtype=0, md={'invars':{}, 'outvar
 
                 for v in eqn.invars:
                     if jtype != 0 and v in jaxpr.invars:
-                        iv_r = get_ivr(md['invars'], v)
+                        iv_r = get_ivr(md['invars'], sv(v), compress=True)
 
                         ivr = get_ivr(update_nodes, iv_r)
 
                         if isinstance(v, core.Literal):
                             edge_from = str(id(v.val))
-                        elif G.has_node(pref + ivr):
+                        elif pref + ivr in nodes:
                             edge_from = pref + ivr
                         else:
                             edge_from = str(ivr)
 
-                        edge_to = pref + str(outv)
+                        edge_to = pref + outv_name
 
                         G.add_edge(edge_from, edge_to)
 
                     else:
-                        from_node = str(v)
                         if isinstance(v, core.Literal):
                             from_node = str(id(v.val))
                         else:
-                            from_node = get_ivr(update_nodes, from_node)
-                        G.add_edge(from_node, str(outv))
+                            from_node = get_ivr(update_nodes, sv(v))
+                        G.add_edge(from_node, outv_name)
 
     for i, v in enumerate(jaxpr.outvars):
+        v_name = sv(v)
         if jtype != 0: # and G.has_node(str(md['outvars'][v])):
-            vr = get_ivr(update_nodes, str(v))
-            ovrs = get_ovrs(md['outvars'], str(v))
+            vr = get_ivr(update_nodes, v_name)
+            ovrs = get_ovrs(v_name)
             for ovr in ovrs:
                 if str(ovr) == str(vr):
                     continue
 
-                if not G.has_node(str(ovr)):
+                if str(ovr) not in nodes:
 
                     update_nodes[ovr] = vr
         else:
-            if not G.has_node(str(v)):
+            if v_name not in nodes:
                 G.add_node(
-                    str(v),
-                    label=str(v),
+                    v_name,
+                    label=v_name,
                     shape=v.aval.shape,
                     dtype=str(v.aval.dtype),
                     type='outvar',
                     remat=remat,
                 )
-                source_node = get_ivr(update_nodes, str(v))
+                source_node = get_ivr(update_nodes, v_name)
 
-                G.add_edge(source_node, str(v))
+                G.add_edge(source_node, v_name)
             else:
-                vr = get_ivr(update_nodes, str(v))
+                vr = get_ivr(update_nodes, v_name)
                 G.nodes[vr]['type'] = 'outvar'
 
+    if is_root:
+        G = G.to_networkx()
     return (G, id_names, update_nodes)
 
 
+# Params that only label an eqn and don't change what it computes
+_LABEL_PARAMS = frozenset(['name'])
+
+def _jaxpr_fingerprint(jaxpr):
+    """sha256 hex digest of a canonical form of a Jaxpr or ClosedJaxpr.
+
+    It covers the consts and every eqn with its primitive, params and
+    operand and result avals, recursing into sub-jaxprs. Vars are numbered
+    in order of appearance, so the digest doesn't depend on their names.
+    """
+    h = hashlib.sha256()
+    _hash_jaxpr(h, jaxpr)
+    return h.hexdigest()
+
+def _hash_jaxpr(h, jaxpr):
+    if isinstance(jaxpr, core.ClosedJaxpr):
+        for c in jaxpr.consts:
+            _hash_param(h, np.asarray(c))
+        jaxpr = jaxpr.jaxpr
+    ids = {}
+
+    def var(v):
+        if isinstance(v, core.Literal):
+            return f'{v.val!r}:{v.aval}'
+        return f'{ids.setdefault(v, len(ids))}:{v.aval}'
+
+    h.update(' '.join(map(var, itertools.chain(jaxpr.constvars,
+                                               jaxpr.invars))).encode())
+    for eqn in jaxpr.eqns:
+        h.update(f"\n{eqn.primitive.name} {' '.join(map(var, eqn.invars))}"
+                 f" -> {' '.join(map(var, eqn.outvars))}".encode())
+        for k in sorted(eqn.params):
+            if k not in _LABEL_PARAMS:
+                h.update(f' {k}='.encode())
+                _hash_param(h, eqn.params[k])
+    h.update(('\n-> ' + ' '.join(map(var, jaxpr.outvars))).encode())
+
+def _hash_param(h, p):
+    if isinstance(p, (core.Jaxpr, core.ClosedJaxpr)):
+        h.update(b'{')
+        _hash_jaxpr(h, p)
+        h.update(b'}')
+    elif isinstance(p, (tuple, list)):
+        h.update(b'(')
+        for x in p:
+            _hash_param(h, x)
+            h.update(b',')
+        h.update(b')')
+    elif isinstance(p, np.ndarray):
+        # repr elides the middle of large arrays
+        h.update(f'{p.dtype}{p.shape}'.encode())
+        h.update(np.ascontiguousarray(p).tobytes())
+    elif callable(p):
+        # Thunks and functions repr with their address
+        h.update(getattr(p, '__qualname__', type(p).__name__).encode())
+    else:
+        h.update(repr(p).encode())
+
+
+# Part of the on-disk graph cache keys, bump it whenever _jaxpr_graph_g or
+# the graphs it builds change
+_GRAPH_CACHE_VERSION = 2
+
+_graph_cache = OrderedDict()
+# Bound on the total number of nodes of the cached graphs. Full-model stage
+# graphs have tens of thousands of nodes each.
+_GRAPH_CACHE_MAX_NODES = int(os.environ.get('PREDTOP_GRAPH_CACHE_NODES', 500_000))
+_graph_cache_nodes = 0
+
+def _clear_graph_cache():
+    global _graph_cache_nodes
+    _graph_cache.clear()
+    _graph_cache_nodes = 0
+
+def _get_sliced_meshes(virtual_mesh, num_hosts, num_devices_per_host,
+                       use_whole_cluster, cache=None):
+    """slice_profiling_submeshes of virtual_mesh, or of the whole Ray cluster.
+
+    cache is a dict owned by the caller that memoizes the slices per submesh
+    shape, so they are released when the caller returns.
+    """
+    owner = get_global_cluster() if use_whole_cluster else virtual_mesh
+    key = (id(owner), num_hosts, num_devices_per_host)
+    # The entry keeps owner alive, so its id can't be reused by another mesh
+    entry = cache.get(key) if cache is not None else None
+    if entry is None:
+        mesh = (owner.get_virtual_physical_mesh() if use_whole_cluster
+                else owner)
+        entry = (owner, mesh.slice_profiling_submeshes(num_hosts,
+                                                       num_devices_per_host))
+        if cache is not None:
+            cache[key] = entry
+    return entry[1]
+
+
+def _unique_stage_jaxprs(stages):
+    """(start, end) of every distinct layer range in stages, in order, and
+    the forward jaxpr of each. All configs of a range share one jaxpr."""
+    keys = []
+    jaxprs = []
+    seen = set()
+    for st in stages:
+        key = (st[0][0], st[0][1])
+        if key not in seen:
+            seen.add(key)
+            keys.append(key)
+            jaxprs.append(st[3][0])
+    return keys, jaxprs
+
+
+def _stage_graph(closed_jaxpr, jpridx):
+    """_jaxpr_graph_g of a stage computation, cached by a structural
+    fingerprint of the jaxpr. Returns a copy since callers mutate it.
+
+    The in-memory cache is LRU, bounded by _GRAPH_CACHE_MAX_NODES.
+
+    Graphs are also pickled to PREDTOP_GRAPH_CACHE_DIR when it is set, so
+    later runs on the same model skip building them. The files are loaded
+    with pickle, so the directory must only be writable by trusted users.
+    """
+    global _graph_cache_nodes
+    key = (jpridx, _jaxpr_fingerprint(closed_jaxpr))
+    G = _graph_cache.get(key)
+    if G is None:
+        cache_dir = os.environ.get('PREDTOP_GRAPH_CACHE_DIR')
+        path = None
+        if cache_dir:
+            digest = hashlib.sha256(repr(
+                (_GRAPH_CACHE_VERSION, nx.__version__) + key).encode()).hexdigest()
+            path = os.path.join(cache_dir, f'{digest}.pkl')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    G = pickle.load(f)
+        if G is None:
+            jpc = JaxPipelineComputation.from_closed_jaxpr('test', closed_jaxpr)
+            G, _, _ = _jaxpr_graph_g(jpc, jpridx=jpridx, update_nodes={})
+            if path is not None:
+                Path(cache_dir).mkdir(parents=True, exist_ok=True)
+                # Write then rename so concurrent runs never read a partial file
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(G, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+        _graph_cache[key] = G
+        _graph_cache_nodes += G.number_of_nodes()
+        # Keep the newest graph even if it exceeds the budget on its own
+        while _graph_cache_nodes > _GRAPH_CACHE_MAX_NODES and len(_graph_cache) > 1:
+            _, evicted = _graph_cache.popitem(last=False)
+            _graph_cache_nodes -= evicted.number_of_nodes()
+    else:
+        _graph_cache.move_to_end(key)
+    return G.copy()
+
+
+def _load_state_dict(path):
+    if _TORCH_LOAD_MMAP:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    return torch.load(path, map_location='cpu', weights_only=True)
+
+
+_model_template = None
+
+def _get_model_template():
+    """Build the predictor architecture once per process."""
+    global _model_template
+    if _model_template is None:
+        _model_template = create_model()['model']
+    return _model_template
+
+
+def _load_mesh_models(submesh_choices, num_autosharding_configs):
+    """Load the saved prediction model of every (mesh, autosharding config).
+
+    Models that were not saved are set to None.
+    """
+    models_dir = os.environ.get('SAVED_MODELS_DIR')
+    assert models_dir is not None, "SAVED_MODELS_DIR is not set"
+    # One directory listing instead of a stat per (mesh, config)
+    with os.scandir(models_dir) as it:
+        available = {e.name for e in it}
+    # All state dicts in one archive, or one {mesh}_{config}.pth file each
+    # as written by older versions
+    archive = None
+    if _MESH_MODELS_ARCHIVE in available:
+        archive = _load_state_dict(os.path.join(models_dir, _MESH_MODELS_ARCHIVE))
+    mesh_models = {}
+    for mesh_id in reversed(range(len(submesh_choices))):
+        for as_id in range(num_autosharding_configs):
+            name = f'{mesh_id}_{as_id}'
+            if archive is not None:
+                state_dict = archive.get(name)
+            elif name + '.pth' in available:
+                state_dict = _load_state_dict(os.path.join(models_dir, name + '.pth'))
+            else:
+                state_dict = None
+            if state_dict is None:
+                mesh_models[(mesh_id, as_id)] = None
+                continue
+            model = copy.deepcopy(_get_model_template())
+            model.load_state_dict(state_dict)
+            mesh_models[(mesh_id, as_id)] = model
+    return mesh_models
+
+
+def _train_predictors(jobs, device=None):
+    # Configs of one mesh share graph objects and training rewrites them in
+    # place, so every job trains on its own copies
+    return [run([G.copy() for G in t_graphs], t_targs, device)
+            for _, t_graphs, t_targs in jobs]
+
+
 def run_model(g, c, i, mesh_id, mm):
     res = run(g, c, i%2)
     mm[(mesh_id, i)] = res
@@ -600,35 +877,25 @@ def pred_latency(
 ):
     cluster_size = virtual_mesh.num_devices
     num_autosharding_configs = len(autosharding_configs[0])
-    mesh_models = {}
-    
-    for mesh_id, _ in reversed(list(enumerate(submesh_choices))):
-        for as_id in range(num_autosharding_configs):
-            if not os.path.exists(os.environ.get('SAVED_MODELS_DIR') + '/' + str(mesh_id) + '_' + str(as_id) + '.pth'):
-                mesh_models[(mesh_id, as_id)] = None
-                continue
-            model_conf = create_model()                    
-            model_conf['model'].load_state_dict(
-                torch.load(os.environ.get('SAVED_MODELS_DIR') + '/' + str(mesh_id) + '_' + str(as_id) + '.pth')
-            )
-            mesh_models[(mesh_id, as_id)] = model_conf['model']
+    mesh_models = _load_mesh_models(submesh_choices, num_autosharding_configs)
+    sc_index = {tuple(s): i for i, s in enumerate(submesh_choices)}
+    as_index_per_mesh = [_as_index(configs) for configs in autosharding_configs]
     
     mesh_profile_results = {}
     for mesh_id, submesh in reversed(list(enumerate(submesh_choices))):
+        # No predictor for this mesh (e.g. the full mesh), nothing to build
+        if all(mesh_models[(mesh_id, asc)] is None
+               for asc in range(num_autosharding_configs)):
+            continue
         tic = time()
         num_hosts, num_devices_per_host = submesh
-        if global_config.profile_with_whole_ray_cluster:
-            whole_cluster_virtual_mesh = get_global_cluster(
-            ).get_virtual_physical_mesh()
-            sliced_virtual_meshes = (
-                whole_cluster_virtual_mesh.slice_profiling_submeshes(
-                    num_hosts, num_devices_per_host))
-        else:
-            sliced_virtual_meshes = virtual_mesh.slice_profiling_submeshes(
-                num_hosts, num_devices_per_host)
+        sliced_virtual_meshes = _get_sliced_meshes(
+            virtual_mesh, num_hosts, num_devices_per_host,
+            global_config.profile_with_whole_ray_cluster)
         
         timers("model_pred_pred_gen").start()
-        print(stage_option)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("stage_option=%r", stage_option)
         
         sts = ([(i[0], i[-1]) for i in stage_option.forward_stage_layer_ids])
         stages = process_training_stages_2d(sts, layers,
@@ -646,24 +913,19 @@ def pred_latency(
         timers("model_pred_pred_gen").stop()
 
         timers("model_pred_pred_pred").start()
-        fwg = {}
-        for i, st in enumerate(stages):
-            fwg[(st[0][0], st[0][1])] = st[3][0]
-
-        gphs = []
-        for i, st in fwg.items():
-            jpc = JaxPipelineComputation.from_closed_jaxpr('test', st)
-            G, _, _ = _jaxpr_graph_g(jpc, jpridx=i)
-            gphs.append(G)
+        stage_keys, stage_jaxprs = _unique_stage_jaxprs(stages)
+        gphs = [_stage_graph(st, i) for i, st in zip(stage_keys, stage_jaxprs)]
+        # Featurize the stage graphs once and share them across configs
+        batches = pred_batches(gphs)
 
         for asc in range(num_autosharding_configs):
             if mesh_models[(mesh_id, asc)] == None:
                 continue
-            res = pred(mesh_models[(mesh_id, asc)], gphs)
-            print(res)
+            res = pred(mesh_models[(mesh_id, asc)], gphs, batches=batches)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("predictions=%r", res)
 
-            for i, val in enumerate(res):
-                layers_tup = list(fwg.keys())[i]
+            for layers_tup, val in zip(stage_keys, res):
                 mesh_profile_results[(layers_tup[0], layers_tup[1], mesh_id, asc)] = val#/100
 
             toc = time()
@@ -672,36 +934,109 @@ def pred_latency(
             print("-" * 50)
         timers("model_pred_pred_pred").stop()
     
-    print(mesh_profile_results)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("mesh_profile_results=%r", mesh_profile_results)
     
     stage_ids = [(i[0], i[-1]) for i in stage_option.forward_stage_layer_ids]
-    mesh_ids = [submesh_choices.index(i) for i in stage_option.submesh_physical_shapes]
-    asids = [get_as_index(autosharding_configs[i],
-                          stage_option.submesh_autosharding_option_dicts[i],
-                          stage_option.submesh_logical_shapes[j]) for j, i in enumerate(mesh_ids)]
-
-    stage_lats = [mesh_profile_results[(
-        stage_ids[i][0],
-        stage_ids[i][1],
-        mesh_ids[i],
-        asids[i] 
-    )] for i in range(len(stage_ids))]
+    mesh_ids = [sc_index[tuple(i)] for i in stage_option.submesh_physical_shapes]
+    asids = [as_index_per_mesh[i].get(
+                _as_key(stage_option.submesh_autosharding_option_dicts[i],
+                        stage_option.submesh_logical_shapes[j])) for j, i in enumerate(mesh_ids)]
+
+    stage_lats = np.fromiter(
+        (mesh_profile_results[(st[0], st[1], mesh_id, as_id)]
+         for st, mesh_id, as_id in zip(stage_ids, mesh_ids, asids)),
+        dtype=np.float64, count=len(stage_ids))
     
-    total_lat = max(stage_lats) * (num_micro_batches - 1) + sum(stage_lats)
+    total_lat = _pipeline_latency(stage_lats, num_micro_batches)
     
     return total_lat
 
-def get_as_index(autosharding_configs, asopts, logical_shape):
-    asids = None
-
+@dataclass
+class ProfileResultTable:
+    """Struct-of-arrays copy of the module compute costs of profile results.
+
+    Module costs of the i-th result are module_costs[module_offsets[i]:module_offsets[i + 1]].
+    """
+    module_offsets: np.ndarray  # (N + 1,) int64
+    module_costs: np.ndarray  # (M,) float64
+
+    @classmethod
+    def from_results(cls, results):
+        counts = np.fromiter((len(pr.module_profile_results) for pr in results),
+                             dtype=np.int64, count=len(results))
+        module_offsets = np.zeros(len(results) + 1, dtype=np.int64)
+        np.cumsum(counts, out=module_offsets[1:])
+        module_costs = np.fromiter(
+            (mr.compute_cost for pr in results for mr in pr.module_profile_results),
+            dtype=np.float64, count=int(module_offsets[-1]))
+        return cls(module_offsets, module_costs)
+
+    def total_costs(self):
+        """Total compute cost of every result."""
+        counts = np.diff(self.module_offsets)
+        return np.bincount(np.repeat(np.arange(len(counts)), counts),
+                           weights=self.module_costs, minlength=len(counts))
+
+def _sum_module_costs(profile_results, cache):
+    """Total module compute cost of every profiled stage.
+
+    cache maps id(result) to (result, module count, total) and is owned by
+    the caller. profile_results accumulate across meshes, so with the same
+    cache later meshes only reduce the results that are new. An entry holds
+    its result object, so the id can't be reused, and is redone when the
+    result gains modules.
+    """
+    costs = {}
+    missing = []
+    for key, pr in profile_results.items():
+        entry = cache.get(id(pr))
+        if entry is not None and entry[1] == len(pr.module_profile_results):
+            costs[key] = entry[2]
+        else:
+            missing.append((key, pr))
+    if missing:
+        table = ProfileResultTable.from_results([pr for _, pr in missing])
+        counts = np.diff(table.module_offsets).tolist()
+        totals = table.total_costs().tolist()
+        for (key, pr), count, total in zip(missing, counts, totals):
+            cache[id(pr)] = (pr, count, total)
+            costs[key] = total
+    return costs
+
+def save_profile_results(profile_results, filename):
+    """Pickle profile results with the highest protocol. The file is written
+    next to filename and renamed, so readers never see a partial dump."""
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, "wb") as f:
+        pickle.dump(profile_results, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+
+def load_profile_results(filename):
+    """Load profile results saved either by np.save (the .npy files written
+    by get_compute_cost_pred) or by pickle.dump."""
+    with open(filename, "rb") as f:
+        if f.read(len(_NPY_MAGIC)) != _NPY_MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+        f.seek(0)
+        return np.load(f, allow_pickle=True).item()
+
+def _pipeline_latency(stage_lats, num_micro_batches):
+    """GPipe latency: every stage once plus the slowest stage per extra micro batch."""
+    return float(stage_lats.max() * (num_micro_batches - 1) + stage_lats.sum())
+
+def _as_key(asopts, logical_shape):
+    return (tuple(sorted(asopts.items())), tuple(logical_shape))
+
+def _as_index(autosharding_configs):
+    """Map (autosharding options, logical shape) to the first matching config."""
+    index = {}
     for i, asc in enumerate(autosharding_configs):
         if asc is None:
             continue
-        print(asc[1], asc[0].shape, asopts)
-        if asc[1] == asopts and asc[0].shape == logical_shape:
-            asids = i
-            break
-    return asids
+        index.setdefault(_as_key(asc[1], asc[0].shape), i)
+    return index
 
 def get_submesh_models(
         virtual_mesh: VirtualPhysicalMesh,
@@ -717,15 +1052,14 @@ def get_submesh_models(
         default_as_option: AutoShardingOption,
         auto_stage_option: "AutoStageOption"
     ):
-    import time
-    st_time = time.time()
+    st_time = time()
     cluster_size = virtual_mesh.num_devices
     assert len(layers) % 2 == 0
     num_autosharding_configs = len(autosharding_configs[0])
 
     if auto_stage_option.cached_profile_result is not None:
-        with open(auto_stage_option.cached_profile_result, "rb") as f:
-            profile_results = pickle.load(f)
+        profile_results = load_profile_results(
+            auto_stage_option.cached_profile_result)
     else:
         profile_results = {}
     print("-" * 20 + " Automatic stage clustering " + "-" * 20)
@@ -733,30 +1067,21 @@ def get_submesh_models(
 
     mesh_models = {}
     train_values = {}
+    module_cost_cache = {}
+    # Both loops below slice the same submeshes
+    sliced_meshes_cache = {}
     
     
     if os.environ.get('SAVED_MODELS_DIR'):
-        for mesh_id, submesh in reversed(list(enumerate(submesh_choices))):
-            for as_id in range(num_autosharding_configs):
-                if not os.path.exists(os.environ.get('SAVED_MODELS_DIR') + '/' + str(mesh_id) + '_' + str(as_id) + '.pth'):
-                    mesh_models[(mesh_id, as_id)] = None
-                    continue
-                model_conf = create_model()                    
-                model_conf['model'].load_state_dict(
-                    torch.load(os.environ.get('SAVED_MODELS_DIR') + '/' + str(mesh_id) + '_' + str(as_id) + '.pth')
-                )
-                mesh_models[(mesh_id, as_id)] = model_conf['model']
-        return mesh_models
+        return _load_mesh_models(submesh_choices, num_autosharding_configs)
     
     for mesh_id, submesh in reversed(list(enumerate(submesh_choices))):
         print(f"- Profiling for submesh {mesh_id} {submesh}:")
         num_hosts, num_devices_per_host = submesh
 
-        whole_cluster_virtual_mesh = get_global_cluster(
-        ).get_virtual_physical_mesh()
-        sliced_virtual_meshes = (
-            whole_cluster_virtual_mesh.slice_profiling_submeshes(
-                num_hosts, num_devices_per_host))
+        sliced_virtual_meshes = _get_sliced_meshes(
+            virtual_mesh, num_hosts, num_devices_per_host, True,
+            sliced_meshes_cache)
 
         # DATAGEN: comment this part
         if sliced_virtual_meshes[0].num_devices == cluster_size:
@@ -773,25 +1098,13 @@ def get_submesh_models(
 
         # Large stages on some models require, very large memory to for inter-operator optimizer parallely
         # So divide it into chunks based on size and then compile each chunk parallely
-        limit = 1500
-        chunks = []
-        stsum = 0
-        current_chunk = []
-        for se in st_ends:
-            diff = se[1] - se[0]
-            if stsum + diff > limit:
-              stsum = 0
-              chunks.append(current_chunk)
-              current_chunk = []
-
-            stsum += diff
-            current_chunk.append(se)
+        chunks = _chunk_by_size(
+            st_ends, np.fromiter((e - s for s, e in st_ends), dtype=np.int64,
+                                 count=len(st_ends)), 1500)
 
-        if len(current_chunk) != 0:
-            chunks.append(current_chunk)
 
-
-        print(chunks)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("chunks=%r", chunks)
         stages = []
 
         count = 0
@@ -814,22 +1127,9 @@ def get_submesh_models(
         timers("train_gen_stage").stop()
         print("Stages generated, total stages = ", len(stages))
 
-        limit = 150
-        stage_chunks = []
-        stsum = 0
-        current_chunk = []
-        for se in stages:
-            diff = se[0][1] - se[0][0]
-            if stsum + diff > limit:
-              stsum = 0
-              stage_chunks.append(current_chunk)
-              current_chunk = []
-
-            stsum += diff
-            current_chunk.append(se)
-
-        if len(current_chunk) != 0:
-            chunks.append(current_chunk)
+        stage_chunks = _chunk_by_size(
+            stages, np.fromiter((st[0][1] - st[0][0] for st in stages),
+                                dtype=np.int64, count=len(stages)), 150)
 
 
         profile_results = {}
@@ -847,18 +1147,12 @@ def get_submesh_models(
 
         timers("graph_process").start()
         print("Profile complete for submesh ", submesh)
-        costs = {}
-        for k, pr in profile_results.items():
-            cost = 0
-            for mr in pr.module_profile_results:
-                cost += mr.compute_cost
-            costs[k] = cost
-
-        fwg = {}
-        for i, st in enumerate(stages):
-            fwg[(st[0][0], st[0][1])] = st[3][0]
+        costs = _sum_module_costs(profile_results, module_cost_cache)
 
-        print(fwg.keys())
+        stage_keys, stage_jaxprs = _unique_stage_jaxprs(stages)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("stage_keys=%r", stage_keys)
 
         cts = []
         for _ in range(num_autosharding_configs):
@@ -866,10 +1160,10 @@ def get_submesh_models(
 
         gph_dict = {}
         count = 0
-        for i, st in fwg.items():
-            jpc = JaxPipelineComputation.from_closed_jaxpr('test', st)
-            G,_, _ = _jaxpr_graph_g(jpc, jpridx=i, update_nodes={})
-            print(G)
+        for i, st in zip(stage_keys, stage_jaxprs):
+            G = _stage_graph(st, i)
+            if debug:
+                logger.debug("%s: %s", i, G)
             as_costs = []
 
             # TODO: UNCOMMENT BLOCK
@@ -894,8 +1188,8 @@ def get_submesh_models(
             # print("render_graph")
             # dgph.render('graph_train/' + str(i[0]) + '_' + str(i[1]) + "_" + str(count))
             count += 1
-        print(gph_dict.keys())
-        print(len(gph_dict.keys()))
+        if debug:
+            logger.debug("%d stage graphs for submesh %s", len(gph_dict), submesh)
 
 
         train_values[mesh_id] = gph_dict
@@ -904,7 +1198,7 @@ def get_submesh_models(
 
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
 
-    print("--- %s seconds ---" % (time.time() - st_time))
+    print("--- %s seconds ---" % (time() - st_time))
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     # with open('train_values_store' + timestamp + '.pkl', 'wb') as f:
     #     pickle.dump(train_values, f)
@@ -918,37 +1212,62 @@ def get_submesh_models(
 
     for mesh_id, submesh in reversed(list(enumerate(submesh_choices))):
         num_hosts, num_devices_per_host = submesh
-        whole_cluster_virtual_mesh = get_global_cluster(
-        ).get_virtual_physical_mesh()
-        sliced_virtual_meshes = (
-            whole_cluster_virtual_mesh.slice_profiling_submeshes(
-                num_hosts, num_devices_per_host))
+        sliced_virtual_meshes = _get_sliced_meshes(
+            virtual_mesh, num_hosts, num_devices_per_host, True,
+            sliced_meshes_cache)
         # DATAGEN: comment this part
         if sliced_virtual_meshes[0].num_devices == cluster_size:
             for asidx in range(num_autosharding_configs):
                 mesh_models[(mesh_id, asidx)] = None
             continue
 
+    # All stage graphs are built, train_values holds the ones still needed
+    _clear_graph_cache()
+
     timers("stage-model-training").start()
+    jobs = []
     for mesh_id in train_values:
-        for as_id in range(num_autosharding_configs):
-
-            t_graphs = []
-            t_targs = []
-            for sub_gph_idx in train_values[mesh_id]:
-                t_graphs.append(train_values[mesh_id][sub_gph_idx][0])
-                t_targs.append(train_values[mesh_id][sub_gph_idx][1][as_id])
+        gph_costs = train_values[mesh_id].values()
+        # (num_stages, num_autosharding_configs), a config whose targets are
+        # all equal has nothing to learn
+        targets = np.array([as_costs for _, as_costs in gph_costs],
+                           dtype=np.float64).reshape(-1, num_autosharding_configs)
+        if len(targets) == 0:
+            is_trivial = np.ones(num_autosharding_configs, dtype=bool)
+        else:
+            is_trivial = targets.max(axis=0) == targets.min(axis=0)
 
-            if len(set(t_targs)) == 1:
+        t_graphs = [G for G, _ in gph_costs]
+        for as_id in range(num_autosharding_configs):
+            if is_trivial[as_id]:
                 mesh_models[(mesh_id, as_id)] = None
             else:
-                res = run(t_graphs, t_targs)
-                mesh_models[(mesh_id, as_id)] = res['model']
-                
-                if os.environ.get('SAVE_MODEL_DIR') is not None:
-                    Path(os.environ.get('SAVE_MODEL_DIR')).mkdir(parents=True, exist_ok=True)
-                    torch.save(res['model'].state_dict(), os.environ.get('SAVE_MODEL_DIR') + '/' + str(mesh_id) + '_' + str(as_id) + '.pth')
-                print(res['model'])
+                jobs.append(((mesh_id, as_id), t_graphs, targets[:, as_id].tolist()))
+
+    # The predictors are independent, train one per GPU at a time
+    num_gpus = torch.cuda.device_count()
+    if num_gpus > 1:
+        with ThreadPoolExecutor(max_workers=num_gpus) as executor:
+            device_results = list(executor.map(
+                _train_predictors, [jobs[d::num_gpus] for d in range(num_gpus)],
+                range(num_gpus)))
+        results = [None] * len(jobs)
+        for d, res in enumerate(device_results):
+            results[d::num_gpus] = res
+    else:
+        results = _train_predictors(jobs)
+
+    state_dicts = {}
+    for ((mesh_id, as_id), _, _), res in zip(jobs, results):
+        mesh_models[(mesh_id, as_id)] = res['model']
+        state_dicts[f'{mesh_id}_{as_id}'] = res['model'].state_dict()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("model %s: %s", (mesh_id, as_id), res['model'])
+
+    if os.environ.get('SAVE_MODEL_DIR') is not None:
+        Path(os.environ.get('SAVE_MODEL_DIR')).mkdir(parents=True, exist_ok=True)
+        torch.save(state_dicts, os.path.join(os.environ.get('SAVE_MODEL_DIR'),
+                                             _MESH_MODELS_ARCHIVE))
 
     timers("stage-model-training").stop()
     return mesh_models
@@ -982,14 +1301,16 @@ def get_compute_cost_pred(
     num_autosharding_configs = len(autosharding_configs[0])
 
     if auto_stage_option.cached_profile_result is not None:
-        with open(auto_stage_option.cached_profile_result, "rb") as f:
-            profile_results = pickle.load(f)
+        profile_results = load_profile_results(
+            auto_stage_option.cached_profile_result)
     else:
         profile_results = {}
     print("-" * 20 + " Automatic stage clustering " + "-" * 20)
     print(f"submesh_choices: {submesh_choices}")
 
     mesh_profile_results =  {}
+    module_cost_cache = {}
+    save_full_mesh_results = False
     
     gphs = []
     # Reverse submesh_choices to test larger meshes first
@@ -998,21 +1319,15 @@ def get_compute_cost_pred(
 
         num_hosts, num_devices_per_host = submesh
         tic = time()
-        if global_config.profile_with_whole_ray_cluster:
-            whole_cluster_virtual_mesh = get_global_cluster(
-            ).get_virtual_physical_mesh()
-            sliced_virtual_meshes = (
-                whole_cluster_virtual_mesh.slice_profiling_submeshes(
-                    num_hosts, num_devices_per_host))
-        else:
-            sliced_virtual_meshes = virtual_mesh.slice_profiling_submeshes(
-                num_hosts, num_devices_per_host)
+        sliced_virtual_meshes = _get_sliced_meshes(
+            virtual_mesh, num_hosts, num_devices_per_host,
+            global_config.profile_with_whole_ray_cluster)
 
 
         if (mesh_id, 0) not in mesh_models or mesh_models[(mesh_id, 0)] == None:
             if os.environ.get('SAVED_MODELS_DIR'):
-                with open(f'{os.environ.get("SAVED_MODELS_DIR")}/full_mesh_results.pkl', 'rb') as f:
-                    profile_results = pickle.load(f)
+                profile_results = load_profile_results(
+                    f'{os.environ.get("SAVED_MODELS_DIR")}/full_mesh_results.pkl')
             else:
                 timers("model_pred_gen").start()
                 stages = generate_training_stages_2d(
@@ -1032,18 +1347,15 @@ def get_compute_cost_pred(
                     auto_stage_option, profile_results, op_type="pred")
 
                 timers("model_pred_profile").stop()
-                if os.environ.get('SAVE_MODEL_DIR') is not None:
-                    Path(os.environ.get('SAVE_MODEL_DIR')).mkdir(parents=True, exist_ok=True)
-                    with open(f'{os.environ.get("SAVE_MODEL_DIR")}/full_mesh_results.pkl', 'wb') as f:
-                        pickle.dump(profile_results, f)
+                # profile_results accumulate, so they are saved once after
+                # the last mesh
+                save_full_mesh_results = os.environ.get('SAVE_MODEL_DIR') is not None
                 
 
-            for idx in profile_results:
-                pr = profile_results[idx]
-                mesh_profile_results[idx] = np.inf 
-                mesh_profile_results[idx] =sum(result.compute_cost for result in pr.module_profile_results)
+            mesh_profile_results.update(_sum_module_costs(profile_results, module_cost_cache))
                 
-            print(profile_results)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("profile_results=%r", profile_results)
             toc = time()
             print(f"Profiling for submesh {mesh_id} {submesh} takes {toc - tic:.2f}"
                 f" seconds")
@@ -1060,15 +1372,11 @@ def get_compute_cost_pred(
                     auto_stage_option.stage_imbalance_tolerance, compile=False, reduce=0)
 
                 print(len(stages))
-                fwg = {}
-                for i, st in enumerate(stages):
-                    fwg[(st[0][0], st[0][1])] = st[3][0]
-
-                for i, st in fwg.items():
-                    jpc = JaxPipelineComputation.from_closed_jaxpr('test', st)
-                    G, _, _ = _jaxpr_graph_g(jpc, jpridx=i)
-                    gphs.append(G)
+                stage_keys, stage_jaxprs = _unique_stage_jaxprs(stages)
+                gphs = [_stage_graph(st, i) for i, st in zip(stage_keys, stage_jaxprs)]
                 print(len(gphs))
+                # Featurize once, every mesh and config predicts on the same batches
+                batches = pred_batches(gphs)
                 timers("model_pred_pred_gen").stop()
             
             # stgs = [s[:3] for s in stages]
@@ -1078,10 +1386,9 @@ def get_compute_cost_pred(
                 
                 if mesh_models[(mesh_id, asc)] == None:
                     continue
-                res = pred(mesh_models[(mesh_id, asc)], gphs)
+                res = pred(mesh_models[(mesh_id, asc)], gphs, batches=batches)
 
-                for i, val in enumerate(res):
-                    layers_tup = list(fwg.keys())[i]
+                for layers_tup, val in zip(stage_keys, res):
                     mesh_profile_results[(layers_tup[0], layers_tup[1], mesh_id, asc)] = val#/100
 
                 print("-" * 50)
@@ -1092,48 +1399,102 @@ def get_compute_cost_pred(
 
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     profile_result_file_name = (f"profile-results-{timestamp}.npy")
+    if save_full_mesh_results:
+        Path(os.environ.get('SAVE_MODEL_DIR')).mkdir(parents=True, exist_ok=True)
+        save_profile_results(
+            profile_results,
+            f'{os.environ.get("SAVE_MODEL_DIR")}/full_mesh_results.pkl')
     np.save(profile_result_file_name, profile_results)
     global last_compute_cost_file_name
     last_compute_cost_file_name = profile_result_file_name
     print(f"Profile result saved to: {profile_result_file_name}")
     print("-" * 70)
 
+    # Stage latencies need no double precision, the DP keeps its own costs
+    # in float32 as well
     all_compute_cost = np.full(
         (num_layers, num_layers, num_submesh_choices, num_autosharding_configs),
         np.inf,
-        dtype=np.float64)
+        dtype=np.float32)
 
     all_max_n_succ_stages = np.full(
         (num_layers, num_layers, num_submesh_choices, num_autosharding_configs),
         np.inf,
         dtype=np.float64)
 
-    for index in np.ndindex(num_layers, num_layers, num_submesh_choices,
-                            num_autosharding_configs):
-        if index not in mesh_profile_results:
-            continue
-        all_compute_cost[index] = mesh_profile_results[index]
-
+    if mesh_profile_results:
+        idx = np.array(list(mesh_profile_results.keys()), dtype=np.intp)
+        costs = np.fromiter(
+            mesh_profile_results.values(), dtype=np.float32,
+            count=len(mesh_profile_results))
+        # Results loaded from full_mesh_results.pkl or a cached profile may
+        # come from another layer or submesh config, skip them like the
+        # per-index loop did
+        in_bounds = ((idx >= 0) & (idx < all_compute_cost.shape)).all(axis=1)
+        if not in_bounds.all():
+            logger.warning(
+                "Ignoring %d profile results outside the compute cost array of "
+                "shape %s", int((~in_bounds).sum()), all_compute_cost.shape)
+            idx = idx[in_bounds]
+            costs = costs[in_bounds]
+        all_compute_cost[tuple(idx.T)] = costs
+
+    _clear_graph_cache()
     return all_compute_cost, all_max_n_succ_stages
 
 
+def _stage_compile_key(stage, profile_results, fingerprints):
+    """Structural key of what compile_all builds for a stage.
+
+    fingerprints memoizes the jaxpr fingerprints by id(mmjpr), which all
+    configs of a layer range share.
+    """
+    stage_indices, _, (logical_mesh, autosharding_option_dict), mmjpr = stage
+    # compile_all skips stages that already have results, keep them apart
+    if stage_indices in profile_results:
+        return stage_indices
+    computation = fingerprints.get(id(mmjpr))
+    if computation is None:
+        computation = fingerprints[id(mmjpr)] = tuple(
+            _jaxpr_fingerprint(jpr) for jpr in mmjpr)
+    return (computation, tuple(logical_mesh.shape),
+            tuple(sorted(autosharding_option_dict.items())))
+
+
 def distributed_profile_on_mesh(stages, meshes: Sequence[VirtualPhysicalMesh],
                                 num_micro_batches, default_as_option,
                                 auto_stage_option, profile_results, op_type="prof"):
     op_type = "-" + op_type
     timers("stage-construction-compilation"+op_type).start()
 
-    stages = [s[:3] for s in stages]
+    # Stages with the same computation and sharding config compile to the
+    # same executable, only compile one of each group
+    group_of = {}
+    unique_ids = []
+    stage_groups = []
+    # stages keeps every mmjpr alive, so the ids stay unique
+    fingerprints = {}
+    for i, stage in enumerate(stages):
+        key = _stage_compile_key(stage, profile_results, fingerprints)
+        if key not in group_of:
+            group_of[key] = len(unique_ids)
+            unique_ids.append(i)
+        stage_groups.append(group_of[key])
+
+    # compile_all and profile_all take (indices, config, autosharding) tuples
+    # and need len(), so only the group representatives are sliced
+    unique_stages = [stages[i][:3] for i in unique_ids]
     
     if len(stages) == 0:
         # Suspend timers
         timers("stage-construction-compilation"+op_type).stop()
         return profile_results
 
-    print("- Compile all stages")
+    print(f"- Compile all stages ({len(unique_ids)} unique of {len(stages)})")
     try:
-        compiled_outputs = compile_all(stages, num_micro_batches,
-                                       default_as_option, profile_results)
+        unique_outputs = compile_all(unique_stages,
+                                     num_micro_batches, default_as_option,
+                                     profile_results)
     except RayActorError as e:
         logger.warning(f"Compilation fatal error: {e}")
         timers("stage-construction-compilation"+op_type).stop()
@@ -1144,9 +1505,16 @@ def distributed_profile_on_mesh(stages, meshes: Sequence[VirtualPhysicalMesh],
     # shape of compute_cost and max_n_succ_stages:
     # (num_layers, num_layers, num_autosharding_configs)
     timers("stage-construction-profiling"+op_type).start()
-    profile_results = profile_all(stages, compiled_outputs, meshes,
+    profile_results = profile_all(unique_stages,
+                                  unique_outputs, meshes,
                                   num_micro_batches, auto_stage_option,
                                   profile_results)
+    # Hand the result of each profiled stage to the rest of its group
+    for i, g in enumerate(stage_groups):
+        rep_idx = stages[unique_ids[g]][0]
+        if i != unique_ids[g] and rep_idx in profile_results:
+            profile_results[stages[i][0]] = copy.deepcopy(
+                profile_results[rep_idx])
     timers("stage-construction-profiling"+op_type).stop()
     return profile_results
 
@@ -1179,14 +1547,15 @@ def generate_stage_info(all_layers, selected_indices,
     all_modules_donate_invars = []
     all_modules_outvars = OrderedSet()
     all_modules_acc_grad_outvars_indices = []
-    acc_grad_invars_set = OrderedSet(acc_grad_invars)
-    acc_grad_outvars_set = OrderedSet(acc_grad_outvars)
+    # Only used for membership tests, jax Vars hash by identity
+    acc_grad_invars_set = frozenset(acc_grad_invars)
+    acc_grad_outvars_set = frozenset(acc_grad_outvars)
     for module_name, jaxprs, accumulator_mapping, required_outvars in zip(
             module_names, module_jaxprs, module_accumulator_mappings,
             module_required_outvars):
         merged_jaxpr = merge_marked_jaxprs_with_named_call(
             jaxprs, required_outvars, accumulator_mapping, module_name)
-        outvars_set = set(merged_jaxpr.jaxpr.outvars)
+        outvars_set = frozenset(merged_jaxpr.jaxpr.outvars)
         is_donated = tuple(invar in accumulator_mapping and
                            accumulator_mapping[invar] in outvars_set
                            for invar in merged_jaxpr.jaxpr.invars)
@@ -1196,8 +1565,8 @@ def generate_stage_info(all_layers, selected_indices,
         acc_grad_outvars_indices = tuple(
             i for i, outvar in enumerate(merged_jaxpr.jaxpr.outvars)
             if outvar in acc_grad_outvars_set)
-        invar_names = tuple(repr(var) for var in merged_jaxpr.jaxpr.invars)
-        outvar_names = tuple(repr(var) for var in merged_jaxpr.jaxpr.outvars)
+        invar_names = tuple(sys.intern(repr(var)) for var in merged_jaxpr.jaxpr.invars)
+        outvar_names = tuple(sys.intern(repr(var)) for var in merged_jaxpr.jaxpr.outvars)
         invar_avals = tuple(var.aval for var in merged_jaxpr.jaxpr.invars)
         outvar_avals = tuple(var.aval for var in merged_jaxpr.jaxpr.outvars)
         profile_config = ModuleProfileConfig(invar_names, outvar_names,
@@ -1222,12 +1591,12 @@ def generate_stage_info(all_layers, selected_indices,
         is_donated = tuple(invar in apply_grad_donation and
                            apply_grad_donation[invar] in outvars_set
                            for invar in merged_apply.jaxpr.invars)
-        apply_only_invars = OrderedSet(merged_apply.jaxpr.invars)
+        module_vars = set()
         for module_jaxpr in module_merged_jaxprs:
-            apply_only_invars = apply_only_invars.difference(
-                module_jaxpr.jaxpr.invars)
-            apply_only_invars = apply_only_invars.difference(
-                module_jaxpr.jaxpr.outvars)
+            module_vars.update(module_jaxpr.jaxpr.invars)
+            module_vars.update(module_jaxpr.jaxpr.outvars)
+        apply_only_invars = OrderedSet(
+            v for v in merged_apply.jaxpr.invars if v not in module_vars)
         apply_info = ApplyGradConfig(merged_apply.jaxpr.invars,
                                      apply_only_invars)
         module_names.append(apply_grad_module_name)
@@ -20,6 +20,7 @@ from alpa.pipeline_parallel.computation import (
     JaxPipelineComputation, merge_marked_jaxprs_with_named_call)
 
 from alpa.pipeline_parallel.stage_profiling import (get_compute_cost)
+import predtop.profile
 from predtop.profile import (get_compute_cost_pred, get_submesh_models, pred_latency)
 from alpa.pipeline_parallel.stage_construction import (
     inference_dp,
@@ -39,6 +40,18 @@ from alpa.timer import timers
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+last_forward_stage_layer_ids = None
+last_submesh_shapes = None
+last_logical_mesh_shapes = None
+last_autosharding_option_dicts = None
+
+
+def get_last_dp_result():
+    """Gets the DP result of the last run."""
+    return (predtop.profile.last_compute_cost_file_name,
+            last_forward_stage_layer_ids, last_submesh_shapes,
+            last_logical_mesh_shapes, last_autosharding_option_dicts)
+
 @dataclass
 class PredStageOption:
     # Layer IDs of each forward stage.